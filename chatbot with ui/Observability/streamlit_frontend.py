@@ -8,7 +8,7 @@ from langgraph_backend import chatbot, retrieve_all_threads
 
 
 def generate_thread_id():
-    thread_id = uuid.uuid4()
+    thread_id = str(uuid.uuid4())
     return thread_id
 
 
@@ -52,8 +52,8 @@ if st.sidebar.button("New Chat"):
 
 st.sidebar.header("My Conversations")
 
-for thread_id in st.session_state["chat_threads"][::-1]:
-    if st.sidebar.button(str(thread_id)):
+for thread_id in reversed(st.session_state["chat_threads"]):
+    if st.sidebar.button(thread_id):
         st.session_state["thread_id"] = thread_id
         messages = load_conversation(thread_id)
 
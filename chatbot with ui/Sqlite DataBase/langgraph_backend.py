@@ -1,6 +1,12 @@
+import atexit
+import queue
 import sqlite3
+import threading
+import time
+from contextlib import contextmanager
 from typing import Annotated, TypedDict
 
+import streamlit as st
 from dotenv import load_dotenv
 from langchain_core.messages import BaseMessage, HumanMessage
 from langchain_groq import ChatGroq
@@ -33,18 +39,108 @@ def chat_node(state: ChatState):
 
 """
 create database and connect it to the checkpointer.
-Thread --> False, because we are going to use the same database across different threads.
+Every thread borrows one of a few long lived connections from a small pool.
 """
 
-conn = sqlite3.connect(
-    database="chat_history.db", check_same_thread=False
-)  # -> connection object
+# A few long lived connections shared by every thread, cursor() checks one out and hands it back afterwards.
+# Streamlit reruns and langgraph's checkpoint writes each run on a fresh thread, so a connection per thread
+# would be opened on nearly every call and its page cache would never be reused
+POOL_SIZE = 4
+
+
+def connect():
+    # check_same_thread=False since a connection moves to whichever thread checks it out
+    conn = sqlite3.connect(database="chat_history.db", check_same_thread=False)
+    # WAL lets readers run alongside checkpoint writes and synchronous=NORMAL skips the fsync on every commit
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA mmap_size=268435456")
+    conn.execute("PRAGMA cache_size=-65536")
+    return conn
+
+
+class PooledSqliteSaver(SqliteSaver):
+    """SqliteSaver that checks a connection out of a small pool for every cursor"""
+
+    def __init__(self, size=POOL_SIZE):
+        # lifo so the most recently used connection, the one with a warm cache, goes out first
+        self.pool = queue.LifoQueue()
+        for _ in range(size):
+            self.pool.put(connect())
+        # connections the calling thread has checked out, SqliteSaver.list reads self.conn inside cursor()
+        self._local = threading.local()
+        super().__init__(conn=None)
+        atexit.register(self.close)
+
+    @property
+    def conn(self):
+        return self._local.checked_out[-1]
+
+    @conn.setter
+    def conn(self, value):
+        # SqliteSaver.__init__ assigns this, the real connections live in the pool
+        pass
+
+    @contextmanager
+    def cursor(self, transaction: bool = True):
+        conn = self.pool.get()
+        checked_out = self._local.__dict__.setdefault("checked_out", [])
+        checked_out.append(conn)
+        try:
+            self.setup()
+            cur = conn.cursor()
+            try:
+                yield cur
+            finally:
+                if transaction:
+                    conn.commit()
+                cur.close()
+        finally:
+            checked_out.pop()
+            self.pool.put(conn)
+
+    def close(self):
+        while not self.pool.empty():
+            self.pool.get().close()
+
+
+# **************** Database Maintenance
+# Keeps the -wal file and the database from growing without bound as conversations pile up
+WAL_CHECKPOINT_INTERVAL = 600  # seconds between wal checkpoints
+# VACUUM on startup only when this many pages are free to reclaim
+VACUUM_FREE_PAGES = 10_000
+
+
+def checkpoint_wal_forever(saver):
+    while True:
+        time.sleep(WAL_CHECKPOINT_INTERVAL)
+        try:
+            # copy the wal back into the database and truncate it
+            with saver.cursor(transaction=False) as cur:
+                cur.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        except sqlite3.OperationalError:
+            # database busy, try again on the next round
+            pass
+
+
+# st.cache_resource so there is only one maintenance thread per process
+# the leading underscore tells streamlit not to hash the saver
+@st.cache_resource
+def start_database_maintenance(_saver):
+    with _saver.cursor(transaction=False) as cur:
+        if cur.execute("PRAGMA freelist_count").fetchone()[0] > VACUUM_FREE_PAGES:
+            cur.execute("VACUUM")
+
+    threading.Thread(target=checkpoint_wal_forever, args=(_saver,), daemon=True).start()
+
 
 # Define the checkpointer
 """
 Now we need sqlite database and connect this checkpointer to that database with the connector of the database
 """
-checkpoints = SqliteSaver(conn=conn)
+checkpoints = PooledSqliteSaver()
+start_database_maintenance(checkpoints)
 
 # Create graph for ChatState
 graph = StateGraph(ChatState)
@@ -60,13 +156,17 @@ workflow = graph.compile(checkpointer=checkpoints)
 
 
 # Retrieve all threads
+# Cached so a page load does not rescan every checkpoint, frontend clears it when a new thread gets saved
+@st.cache_data(ttl=60)
 def retrieve_all_threads():
-    all_threads = set()
-
-    for chpt in checkpoints.list(None):
-        all_threads.add(chpt.config["configurable"]["thread_id"])
-
-    return list(all_threads)
+    # Ask sqlite for the distinct thread ids directly rather than decoding every checkpoint with checkpoints.list
+    # thread_id is the first column of the primary key so this is served from the index
+    # checkpoint ids are time ordered (uuid6) so the latest one orders threads from oldest to most recently updated
+    with checkpoints.cursor(transaction=False) as cur:
+        cur.execute(
+            "SELECT thread_id FROM checkpoints GROUP BY thread_id ORDER BY MAX(checkpoint_id)"
+        )
+        return [row[0] for row in cur.fetchall()]
 
 
 if __name__ == "__main__":
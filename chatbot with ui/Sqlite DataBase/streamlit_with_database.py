@@ -1,15 +1,19 @@
 import uuid
+from itertools import islice
 
 import streamlit as st
 from langchain_core.messages import HumanMessage
 from langgraph_backend import retrieve_all_threads, workflow
 
+# Only this many chats are rendered in the sidebar until "Load older" is clicked
+THREADS_PER_PAGE = 25
+
 # *************** Utility Functions *****************
 
 
 # Generate Random Thread id
 def generate_thread_id():
-    thread_id = uuid.uuid4()
+    thread_id = str(uuid.uuid4())
     return thread_id
 
 
@@ -29,15 +33,23 @@ def reset_chat():
 
 # Add Thread to thread list for switching chats
 def add_thread(thread_id):
-    # first check if thread_id is in list or not
-    if thread_id not in st.session_state["chat_threads"]:
+    # first check if thread_id is already there, the set makes this check O(1) while the list keeps the order
+    if thread_id not in st.session_state["chat_threads_set"]:
+        st.session_state["chat_threads_set"].add(thread_id)
         st.session_state["chat_threads"].append(
             thread_id
         )  # we need to append not replace
 
 
+# Show older chats in the sidebar
+def load_older_threads():
+    st.session_state["threads_shown"] += THREADS_PER_PAGE
+
+
 # TO load all conversation of particular thread
-def load_conversation(thread_id):
+# cached per thread id
+@st.cache_data(ttl=300, max_entries=64)
+def load_conversation(thread_id: str):
     state = workflow.get_state(config={"configurable": {"thread_id": thread_id}})
 
     # Check if messages key exists in state values, return empty list if not
@@ -59,6 +71,10 @@ if "thread_id" not in st.session_state:
 # call the all threads retrievel function
 if "chat_threads" not in st.session_state:
     st.session_state["chat_threads"] = retrieve_all_threads()
+    st.session_state["chat_threads_set"] = set(st.session_state["chat_threads"])
+
+if "threads_shown" not in st.session_state:
+    st.session_state["threads_shown"] = THREADS_PER_PAGE
 
 # add current thread to list
 add_thread(st.session_state["thread_id"])
@@ -79,30 +95,36 @@ if st.sidebar.button("New Chat"):
 st.sidebar.header("Your Chats")
 
 # Display list of thread_ids(Reverse for giving latest chat at top)
-for id in st.session_state["chat_threads"][::-1]:
+# Only the latest threads_shown chats get a button
+for id in islice(
+    reversed(st.session_state["chat_threads"]), st.session_state["threads_shown"]
+):
     # Load the conversation for the button clicked
-    if st.sidebar.button(str(id)):
+    if st.sidebar.button(id):
         # also store it in thread id
         st.session_state["thread_id"] = id
 
         # Here the issue is the format of the message which we are getting from load conversation is in HumanMessage format but our message history is in role and content dictionary so we need to manually write some code
         messages = load_conversation(id)
 
-        temp_messages = []
-
-        # We are just extracting the role and content and append it to temp dictionary
+        # We are just extracting the role and content of each message into a dictionary
+        # msg.type is "human" for user messages and "ai" for llm replies, which is cheaper than an isinstance check
 
-        # Then in last we are appending our temp message to actual message history
-
-        for _ in temp_messages:
-            if isinstance(_, HumanMessage):
-                role = "user"
-            else:
-                role = "assistant"
-            temp_messages.append({"role": role, "content": _.content})
+        # Then in last we are setting our temp message as actual message history
+        temp_messages = [
+            {
+                "role": "user" if msg.type == "human" else "assistant",
+                "content": msg.content,
+            }
+            for msg in messages
+            if msg.type in ("human", "ai")
+        ]
 
         st.session_state["message_history"] = temp_messages
 
+if len(st.session_state["chat_threads"]) > st.session_state["threads_shown"]:
+    st.sidebar.button("Load older", on_click=load_older_threads)
+
 
 # ******************** Main UI ********************
 
@@ -131,6 +153,8 @@ if user_input:
                 {"messages": [HumanMessage(content=user_input)]},
                 config=CONFIG,
                 stream_mode="messages",
+                # save one checkpoint when the turn finishes instead of one per step
+                durability="exit",
             )
         )
 
@@ -138,3 +162,10 @@ if user_input:
     st.session_state["message_history"].append(
         {"role": "assistant", "content": ai_message}
     )
+
+    # The thread has new messages now, so drop its cached conversation
+    load_conversation.clear(st.session_state["thread_id"])
+
+    # First message of a new chat is what saves the thread in database, so refresh the cached thread list
+    if len(st.session_state["message_history"]) == 2:
+        retrieve_all_threads.clear()
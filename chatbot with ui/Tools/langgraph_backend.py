@@ -1,27 +1,40 @@
+import atexit
+import operator
 import os
+import queue
 import sqlite3
+import threading
+import time
+from contextlib import contextmanager
 from typing import Annotated, TypedDict
 
 import requests
+import streamlit as st
 from dotenv import load_dotenv
 from langchain_community.tools import DuckDuckGoSearchRun
-from langchain_core.messages import BaseMessage
+from langchain_core.messages import AIMessage, BaseMessage
 from langchain_core.tools import tool
 from langchain_groq import ChatGroq
+from langgraph.checkpoint.serde.jsonplus import JsonPlusSerializer
 from langgraph.checkpoint.sqlite import SqliteSaver
 from langgraph.graph import START, StateGraph
 from langgraph.graph.message import add_messages
 from langgraph.prebuilt import ToolNode, tools_condition
+from requests.adapters import HTTPAdapter
 
 os.environ["LANGSMITH_PROJECT"] = "chatbot-project"
-load_dotenv()
-
-llm = ChatGroq(model="openai/gpt-oss-20b")
 
 # ********************* Making Tools
 
-# Creating Tools
-search_tool = DuckDuckGoSearchRun()
+
+# Supported calculator operations, one dict lookup picks the function instead of an if/elif chain
+# divide returns 0 when dividing by zero
+CALCULATOR_OPERATIONS = {
+    "add": operator.add,
+    "subtract": lambda a, b: abs(a - b),
+    "multiply": lambda a, b: round(a * b, 2),
+    "divide": lambda a, b: 0 if b == 0 else round(a / b, 2),
+}
 
 
 # Custom Calulator Tool
@@ -32,28 +45,24 @@ def calculator(first_num: float, second_num: float, operation: str) -> dict:
     Supported operations are add, subtract, multiply, divide
     """
 
-    try:
-        if operation == "add":
-            result = first_num + second_num
-        elif operation == "subtract":
-            result = abs(first_num - second_num)
-        elif operation == "multiply":
-            result = round(first_num * second_num, 2)
-        elif operation == "divide":
-            if second_num == 0:
-                result = 0
-            result = round(first_num / second_num, 2)
-        else:
-            return {"Error": f"Invalid Operation{operation}"}
-
-        return {
-            "first_num": first_num,
-            "second_num": second_num,
-            "operation": operation,
-            "result": result,
-        }
-    except Exception as e:
-        return {"error": str(e)}
+    operation_fn = CALCULATOR_OPERATIONS.get(operation)
+    if operation_fn is None:
+        return {"Error": f"Invalid Operation{operation}"}
+
+    return {
+        "first_num": first_num,
+        "second_num": second_num,
+        "operation": operation,
+        "result": operation_fn(first_num, second_num),
+    }
+
+
+# One session for the stock api so repeated tool calls reuse keep-alive connections instead of a new TCP + TLS handshake each time
+stock_session = requests.Session()
+stock_session.headers.update({"accept": "application/json"})
+stock_session.mount(
+    "https://api.freeapi.app", HTTPAdapter(pool_connections=4, pool_maxsize=8)
+)
 
 
 # get stock price
@@ -65,18 +74,11 @@ def get_stock_price(symbol: str) -> dict:
 
     url = f"https://api.freeapi.app/api/v1/public/stocks/{symbol}"
 
-    headers = {"accept": "application/json"}
-    response = requests.get(url=url, headers=headers)
+    response = stock_session.get(url=url, timeout=5)
 
     return response.json()
 
 
-# ********************* Bindind Tools with LLM
-
-all_tools = [search_tool, calculator, get_stock_price]
-llm_with_tool = llm.bind_tools(all_tools)
-
-
 # ******************* Creating Graph,Nodes,Edges
 
 
@@ -84,43 +86,180 @@ class ChatState(TypedDict):
     messages: Annotated[list[BaseMessage], add_messages]
 
 
-def chat_node(state: ChatState):
-    messages = state["messages"]
-    response = llm_with_tool.invoke(messages)
-    return {"messages": [response]}
-
-
-# Tool Node : It will have all tools
-tool_node = ToolNode(all_tools)
-
 # **************** Checkpointer Code
 
-conn = sqlite3.connect(database="chatbot.db", check_same_thread=False)
-# Checkpointer
-checkpointer = SqliteSaver(conn=conn)
-
-
-# *************** Nodes of the Graph
-graph = StateGraph(ChatState)
-graph.add_node("chat_node", chat_node)
-# We have to make the node name for tool node as tools because tool_condition explicitly have the literal end & tools so that it can identify which node to go
-graph.add_node("tools", tool_node)
-
-
-# *************** Edges
-graph.add_edge(START, "chat_node")
-
-# If LLM asked for tool, then go to tool node else finish
-graph.add_conditional_edges("chat_node", tools_condition)
-# Add another node from tool to chat node so that outputs are polish and we can perform multistep tool calling
-graph.add_edge("tools", "chat_node")
-
-chatbot = graph.compile(checkpointer=checkpointer)
-
-
+# A few long lived connections shared by every thread, cursor() checks one out and hands it back afterwards.
+# Streamlit reruns and langgraph's checkpoint writes each run on a fresh thread, so a connection per thread
+# would be opened on nearly every call and its page cache would never be reused
+POOL_SIZE = 4
+
+
+def connect():
+    # check_same_thread=False since a connection moves to whichever thread checks it out
+    conn = sqlite3.connect(database="chatbot.db", check_same_thread=False)
+    # WAL lets readers run alongside checkpoint writes and synchronous=NORMAL skips the fsync on every commit
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA mmap_size=268435456")
+    conn.execute("PRAGMA cache_size=-65536")
+    return conn
+
+
+# The ui only needs role + content (and the llm needs tool calls) to continue a chat, so the token usage,
+# provider response metadata and raw additional_kwargs of every message are not worth writing to the database
+def strip_message_metadata(value):
+    if isinstance(value, BaseMessage):
+        update = {"additional_kwargs": {}, "response_metadata": {}}
+        if isinstance(value, AIMessage):
+            update["usage_metadata"] = None
+        return value.model_copy(update=update)
+    if isinstance(value, list):
+        return [strip_message_metadata(item) for item in value]
+    if isinstance(value, dict):
+        return {key: strip_message_metadata(item) for key, item in value.items()}
+    return value
+
+
+# The encoding itself stays JsonPlusSerializer's default: ormsgpack (a rust msgpack encoder, not pickle) which
+# already rebuilds messages on load. An orjson codec measured about the same once messages have to be rebuilt.
+class CompactSerializer(JsonPlusSerializer):
+    """Checkpoint serializer that drops message metadata before encoding"""
+
+    def dumps_typed(self, obj):
+        return super().dumps_typed(strip_message_metadata(obj))
+
+
+class PooledSqliteSaver(SqliteSaver):
+    """SqliteSaver that checks a connection out of a small pool for every cursor"""
+
+    def __init__(self, size=POOL_SIZE):
+        # lifo so the most recently used connection, the one with a warm cache, goes out first
+        self.pool = queue.LifoQueue()
+        for _ in range(size):
+            self.pool.put(connect())
+        # connections the calling thread has checked out, SqliteSaver.list reads self.conn inside cursor()
+        self._local = threading.local()
+        super().__init__(conn=None, serde=CompactSerializer())
+        atexit.register(self.close)
+
+    @property
+    def conn(self):
+        return self._local.checked_out[-1]
+
+    @conn.setter
+    def conn(self, value):
+        # SqliteSaver.__init__ assigns this, the real connections live in the pool
+        pass
+
+    @contextmanager
+    def cursor(self, transaction: bool = True):
+        conn = self.pool.get()
+        checked_out = self._local.__dict__.setdefault("checked_out", [])
+        checked_out.append(conn)
+        try:
+            self.setup()
+            cur = conn.cursor()
+            try:
+                yield cur
+            finally:
+                if transaction:
+                    conn.commit()
+                cur.close()
+        finally:
+            checked_out.pop()
+            self.pool.put(conn)
+
+    def close(self):
+        while not self.pool.empty():
+            self.pool.get().close()
+
+
+# **************** Database Maintenance
+# Keeps the -wal file and the database from growing without bound as conversations pile up
+WAL_CHECKPOINT_INTERVAL = 600  # seconds between wal checkpoints
+# VACUUM on startup only when this many pages are free to reclaim
+VACUUM_FREE_PAGES = 10_000
+
+
+def checkpoint_wal_forever(saver):
+    while True:
+        time.sleep(WAL_CHECKPOINT_INTERVAL)
+        try:
+            # copy the wal back into the database and truncate it
+            with saver.cursor(transaction=False) as cur:
+                cur.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        except sqlite3.OperationalError:
+            # database busy, try again on the next round
+            pass
+
+
+# st.cache_resource so there is only one maintenance thread per process
+# the leading underscore tells streamlit not to hash the saver
+@st.cache_resource
+def start_database_maintenance(_saver):
+    with _saver.cursor(transaction=False) as cur:
+        if cur.execute("PRAGMA freelist_count").fetchone()[0] > VACUUM_FREE_PAGES:
+            cur.execute("VACUUM")
+
+    threading.Thread(target=checkpoint_wal_forever, args=(_saver,), daemon=True).start()
+
+
+# *************** Building the Chatbot
+# st.cache_resource keeps one llm, search tool, tool node, checkpointer and compiled graph per process,
+# so when streamlit reloads this module none of them (nor the .env parsing) is done again
+@st.cache_resource
+def build_chatbot():
+    load_dotenv()
+
+    llm = ChatGroq(model="openai/gpt-oss-20b")
+
+    # Creating Tools
+    search_tool = DuckDuckGoSearchRun()
+
+    # ********************* Bindind Tools with LLM
+    all_tools = [search_tool, calculator, get_stock_price]
+    llm_with_tool = llm.bind_tools(all_tools)
+
+    def chat_node(state: ChatState):
+        messages = state["messages"]
+        response = llm_with_tool.invoke(messages)
+        return {"messages": [response]}
+
+    # Tool Node : It will have all tools
+    tool_node = ToolNode(all_tools)
+
+    # Checkpointer
+    checkpointer = PooledSqliteSaver()
+    start_database_maintenance(checkpointer)
+
+    # *************** Nodes of the Graph
+    graph = StateGraph(ChatState)
+    graph.add_node("chat_node", chat_node)
+    # We have to make the node name for tool node as tools because tool_condition explicitly have the literal end & tools so that it can identify which node to go
+    graph.add_node("tools", tool_node)
+
+    # *************** Edges
+    graph.add_edge(START, "chat_node")
+
+    # If LLM asked for tool, then go to tool node else finish
+    graph.add_conditional_edges("chat_node", tools_condition)
+    # Add another node from tool to chat node so that outputs are polish and we can perform multistep tool calling
+    graph.add_edge("tools", "chat_node")
+
+    return graph.compile(checkpointer=checkpointer), checkpointer
+
+
+# Cached so a page load does not rescan every checkpoint, frontend clears it when a new thread gets saved
+@st.cache_data(ttl=60)
 def retrieve_all_threads():
-    all_threads = set()
-    for checkpoint in checkpointer.list(None):
-        all_threads.add(checkpoint.config["configurable"]["thread_id"])
-
-    return list(all_threads)
+    _, checkpointer = build_chatbot()
+
+    # Ask sqlite for the distinct thread ids directly rather than decoding every checkpoint with checkpointer.list
+    # thread_id is the first column of the primary key so this is served from the index
+    # checkpoint ids are time ordered (uuid6) so the latest one orders threads from oldest to most recently updated
+    with checkpointer.cursor(transaction=False) as cur:
+        cur.execute(
+            "SELECT thread_id FROM checkpoints GROUP BY thread_id ORDER BY MAX(checkpoint_id)"
+        )
+        return [row[0] for row in cur.fetchall()]
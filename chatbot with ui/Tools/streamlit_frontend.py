@@ -1,14 +1,24 @@
+import queue
+import threading
 import uuid
+from contextvars import copy_context
+from itertools import islice
 
 import streamlit as st
-from langchain_core.messages import AIMessage, HumanMessage, ToolMessage
-from langgraph_backend import chatbot, retrieve_all_threads
+from langchain_core.messages import HumanMessage
+from langgraph_backend import build_chatbot, retrieve_all_threads
+
+# Built once per process and reused on every rerun (st.cache_resource)
+chatbot, _ = build_chatbot()
+
+# Only this many chats are rendered in the sidebar until "Load older" is clicked
+THREADS_PER_PAGE = 25
 
 # **************************************** utility functions *************************
 
 
 def generate_thread_id():
-    thread_id = uuid.uuid4()
+    thread_id = str(uuid.uuid4())
     return thread_id
 
 
@@ -20,16 +30,62 @@ def reset_chat():
 
 
 def add_thread(thread_id):
-    if thread_id not in st.session_state["chat_threads"]:
+    # the set makes the membership check O(1), the list keeps the order for the sidebar
+    if thread_id not in st.session_state["chat_threads_set"]:
+        st.session_state["chat_threads_set"].add(thread_id)
         st.session_state["chat_threads"].append(thread_id)
 
 
-def load_conversation(thread_id):
+def load_older_threads():
+    st.session_state["threads_shown"] += THREADS_PER_PAGE
+
+
+# cached, cleared after every turn of that thread
+@st.cache_data(ttl=300, max_entries=64)
+def load_conversation(thread_id: str):
     state = chatbot.get_state(config={"configurable": {"thread_id": thread_id}})
     # Check if messages key exists in state values, return empty list if not
     return state.values.get("messages", [])
 
 
+def stream_in_background(graph_input, config):
+    # SqliteSaver has no async api so chatbot.astream is not an option here.
+    # Instead chatbot.stream runs on a worker thread, it keeps reading tokens from the llm and writing checkpoints
+    # while this thread renders them, and the queue hands the chunks across
+    chunks = queue.Queue()
+    done = object()
+    failure = {}
+    # set when the reader goes away (rerun, stop button), the worker then stops the run instead of finishing the turn
+    stop = threading.Event()
+
+    def worker():
+        try:
+            # durability="exit" saves one checkpoint when the turn finishes instead of one per node (chat -> tools -> chat)
+            for item in chatbot.stream(
+                graph_input, config=config, stream_mode="messages", durability="exit"
+            ):
+                if stop.is_set():
+                    # leaving the loop closes chatbot.stream, so no more llm / tool calls are made
+                    break
+                chunks.put(item)
+        except Exception as e:
+            failure["error"] = e
+        finally:
+            chunks.put(done)
+
+    # copy the context so langsmith tracing follows the run onto the worker thread
+    threading.Thread(target=copy_context().run, args=(worker,), daemon=True).start()
+
+    try:
+        while (item := chunks.get()) is not done:
+            yield item
+    finally:
+        stop.set()
+
+    if "error" in failure:
+        raise failure["error"]
+
+
 # **************************************** Session Setup ******************************
 if "message_history" not in st.session_state:
     st.session_state["message_history"] = []
@@ -39,6 +95,10 @@ if "thread_id" not in st.session_state:
 
 if "chat_threads" not in st.session_state:
     st.session_state["chat_threads"] = retrieve_all_threads()
+    st.session_state["chat_threads_set"] = set(st.session_state["chat_threads"])
+
+if "threads_shown" not in st.session_state:
+    st.session_state["threads_shown"] = THREADS_PER_PAGE
 
 add_thread(st.session_state["thread_id"])
 
@@ -52,22 +112,30 @@ if st.sidebar.button("New Chat"):
 
 st.sidebar.header("My Conversations")
 
-for thread_id in st.session_state["chat_threads"][::-1]:
-    if st.sidebar.button(str(thread_id)):
+# newest chats first, "Load older" below shows more
+for thread_id in islice(
+    reversed(st.session_state["chat_threads"]), st.session_state["threads_shown"]
+):
+    if st.sidebar.button(thread_id):
         st.session_state["thread_id"] = thread_id
         messages = load_conversation(thread_id)
 
-        temp_messages = []
-
-        for msg in messages:
-            if isinstance(msg, HumanMessage):
-                role = "user"
-            else:
-                role = "assistant"
-            temp_messages.append({"role": role, "content": msg.content})
+        # msg.type is "human" / "ai" / "tool", tool messages are not part of the visible chat
+        # and neither are the ai messages that only carry tool calls (their content is empty)
+        temp_messages = [
+            {
+                "role": "user" if msg.type == "human" else "assistant",
+                "content": msg.content,
+            }
+            for msg in messages
+            if msg.type in ("human", "ai") and msg.content
+        ]
 
         st.session_state["message_history"] = temp_messages
 
+if len(st.session_state["chat_threads"]) > st.session_state["threads_shown"]:
+    st.sidebar.button("Load older", on_click=load_older_threads)
+
 
 # **************************************** Main UI ************************************
 
@@ -100,13 +168,14 @@ if user_input:
 
         # now since our llm have 2 messages, tool message and ai message we have to check if it is ai message then only stream and dont stream the tool message
         def ai_message_stream_only():
-            for message_chunk, metadata in chatbot.stream(
-                {"messages": [HumanMessage(content=user_input)]},
-                config=CONFIG,
-                stream_mode="messages",
+            for message_chunk, metadata in stream_in_background(
+                {"messages": [HumanMessage(content=user_input)]}, config=CONFIG
             ):
+                # read the type once, a plain string compare is cheaper than isinstance on every token
+                message_type = message_chunk.type
+
                 # Lazily create & update the SAME status container when any tool runs
-                if isinstance(message_chunk, ToolMessage):
+                if message_type == "tool":
                     tool_name = getattr(message_chunk, "name", "tool")
                     if status_holder["box"] is None:
                         status_holder["box"] = st.status(
@@ -119,8 +188,8 @@ if user_input:
                             expanded=True,
                         )
 
-                # Only AI Message
-                if isinstance(message_chunk, AIMessage):
+                # Only AI Message (streamed tokens are "AIMessageChunk", a whole reply is "ai")
+                elif message_type == "AIMessageChunk" or message_type == "ai":
                     yield message_chunk.content
 
         # Now stream the message chunk using yield
@@ -135,3 +204,10 @@ if user_input:
     st.session_state["message_history"].append(
         {"role": "assistant", "content": ai_message}
     )
+
+    # The thread has new messages now, so drop its cached conversation
+    load_conversation.clear(st.session_state["thread_id"])
+
+    # First message of a new chat is what saves the thread in database, so refresh the cached thread list
+    if len(st.session_state["message_history"]) == 2:
+        retrieve_all_threads.clear()
@@ -33,14 +33,17 @@ if user_input:
     # The change for ai message will be here so we only need to made changes here
 
     # user input, our thread and since out state is list of annotated message we need to maps of list messages
-    response = workflow.invoke(
-        {"messages": [HumanMessage(content=user_input)]}, config=CONFIG
-    )
+    # Stream the reply so the first tokens show up right away instead of waiting for the whole response with invoke
+    with st.chat_message("assistant"):
+        ai_message = st.write_stream(
+            message_chunk.content
+            for message_chunk, meta_data in workflow.stream(
+                {"messages": [HumanMessage(content=user_input)]},
+                config=CONFIG,
+                stream_mode="messages",
+            )
+        )
 
-    # since ai message will be last one
-    ai_message = response["messages"][-1].content
     st.session_state["message_history"].append(
         {"role": "assistant", "content": ai_message}
     )
-    with st.chat_message("assistant"):
-        st.text(ai_message)
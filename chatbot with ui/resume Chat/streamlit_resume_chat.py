@@ -9,7 +9,7 @@ from langgraph_backend import workflow
 
 # Generate Random Thread id
 def generate_thread_id():
-    thread_id = uuid.uuid4()
+    thread_id = str(uuid.uuid4())
     return thread_id
 
 
@@ -80,27 +80,26 @@ if st.sidebar.button("New Chat"):
 st.sidebar.header("Your Chats")
 
 # Display list of thread_ids(Reverse for giving latest chat at top)
-for id in st.session_state["chat_threads"][::]:
+for id in reversed(st.session_state["chat_threads"]):
     # Load the conversation for the button clicked
-    if st.sidebar.button(str(id)):
+    if st.sidebar.button(id):
         # also store it in thread id
         st.session_state["thread_id"] = id
 
         # Here the issue is the format of the message which we are getting from load conversation is in HumanMessage format but our message history is in role and content dictionary so we need to manually write some code
         messages = load_conversation(id)
 
-        temp_messages = []
-
-        # We are just extracting the role and content and append it to temp dictionary
-
-        # Then in last we are appending our temp message to actual message history
-
-        for _ in temp_messages:
-            if isinstance(_, HumanMessage):
-                role = "user"
-            else:
-                role = "assistant"
-            temp_messages.append({"role": role, "content": _.content})
+        # We are just extracting the role and content of each message into a dictionary
+        # (one comprehension over messages builds the list in one pass)
+
+        # Then in last we are setting our temp message as actual message history
+        temp_messages = [
+            {
+                "role": "user" if isinstance(msg, HumanMessage) else "assistant",
+                "content": msg.content,
+            }
+            for msg in messages
+        ]
 
         st.session_state["message_history"] = temp_messages
 
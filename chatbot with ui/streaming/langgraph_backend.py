@@ -1,72 +1,472 @@
-from typing import Annotated, TypedDict
+import asyncio
+import atexit
+import functools
+import hashlib
+import importlib.util
+import json
+import queue
+import re
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from dataclasses import dataclass, field
+from typing import Annotated
 
+import httpx
+import streamlit as st
 from dotenv import load_dotenv
-from langchain_core.messages import BaseMessage, HumanMessage
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage, SystemMessage
+from langchain_core.runnables import RunnableConfig
 from langchain_groq import ChatGroq
 from langgraph.checkpoint.memory import InMemorySaver
+from langgraph.constants import TAG_NOSTREAM
 from langgraph.graph import END, START, StateGraph
 from langgraph.graph.message import add_messages
 
-load_dotenv()
+# the small fast model answers by default, the bigger one only when the user picks it
+DEFAULT_MODEL = "llama-3.1-8b-instant"
+MODELS = (DEFAULT_MODEL, "llama-3.3-70b-versatile")
+
+
+# .env is read once per process, get_llm below is cached per model and max_tokens so it would read it for every client
+@functools.cache
+def load_env():
+    load_dotenv()
+    return True
+
+
+# One http client shared by every ChatGroq instance (all models and length bins) so they use a single keep-alive pool,
+# with the optional h2 package installed concurrent drafts and sessions also share one HTTP/2 connection
+@st.cache_resource(show_spinner=False)
+def get_http_client():
+    client = httpx.AsyncClient(
+        http2=importlib.util.find_spec("h2") is not None,
+        limits=httpx.Limits(max_connections=64, max_keepalive_connections=32),
+        timeout=httpx.Timeout(60.0, connect=5.0),
+    )
+    atexit.register(close_http_client, client)
+    return client
+
+
+def close_http_client(client):
+    try:
+        # the client belongs to the background loop, so it has to be closed there
+        asyncio.run_coroutine_threadsafe(client.aclose(), get_event_loop()).result(5)
+    except Exception:
+        pass
+
 
 # Create LLM
-llm = ChatGroq(model="llama-3.1-8b-instant")
+# one capped ChatGroq client per model and max_tokens, cached so it is built once per process and not on every call
+@st.cache_resource(show_spinner=False)
+def get_llm(model=DEFAULT_MODEL, max_tokens=512):
+    load_env()
+    return ChatGroq(
+        model=model,
+        max_tokens=max_tokens,
+        temperature=0.7,
+        stop=["\n\nUser:"],
+        http_async_client=get_http_client(),
+    )
+
+
+# Event loop for the async graph
+# One loop runs on a background thread for the whole process. asyncio.run would make a new loop every turn,
+# but the llm's async http client stays bound to the loop it first ran on, so every turn has to use the same one
+@st.cache_resource(show_spinner=False)
+def get_event_loop():
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return loop
+
+
+# Iterate an async generator (like workflow.astream) from normal sync code such as st.write_stream
+# The generator runs on the background loop and a queue hands every item back to the calling thread
+def iter_async(agen):
+    items = queue.Queue()
+    done = object()
+    failure = {}
+
+    async def pump():
+        try:
+            async for item in agen:
+                items.put(item)
+        except Exception as e:
+            failure["error"] = e
+        finally:
+            items.put(done)
+
+    future = asyncio.run_coroutine_threadsafe(pump(), get_event_loop())
+    try:
+        while (item := items.get()) is not done:
+            yield item
+    finally:
+        # stop the stream if the caller stopped reading early
+        future.cancel()
+
+    if "error" in failure:
+        raise failure["error"]
+
+
+# Requests are split into bins by their expected reply length and longer bins get a bigger reply cap
+# the user message length is the guess for the reply length: < 200 chars, < 1000 chars, longer
+# a short question can still need a long answer, so even the smallest cap is the 512 token default
+LENGTH_BINS = (200, 1000)
+BIN_MAX_TOKENS = (512, 1024, 2048)
+
+
+def length_bin(text):
+    for index, limit in enumerate(LENGTH_BINS):
+        if len(text) < limit:
+            return index
+    return len(LENGTH_BINS)
+
+
+# Warm up
+# The first request pays for dns, the tls handshake and auth, so a 1 token call when the workflow is built
+# pays that before the first user message does. Set to False to skip the extra request
+WARM_UP_LLM = True
+
+
+def warm_up():
+    async def ping():
+        try:
+            # the client of the default model and the short bin, the one the first chat turn uses
+            await get_llm(DEFAULT_MODEL, BIN_MAX_TOKENS[0]).ainvoke(
+                "ping", max_tokens=1
+            )
+        except Exception:
+            # only a warm up, a real problem shows up on the real call
+            pass
+
+    # fire and forget on the background loop, so it is the async client used by the chat that gets warm
+    asyncio.run_coroutine_threadsafe(ping(), get_event_loop())
 
 
 # Create state of out message
-class ChatState(TypedDict):
-    messages: Annotated[list[BaseMessage], add_messages]
+# a slots dataclass: nodes get attribute access and fields missing from the checkpoint get their defaults
+@dataclass(slots=True)
+class ChatState:
+    messages: Annotated[list[BaseMessage], add_messages] = field(default_factory=list)
+    # running summary of the oldest messages and how many messages it covers
+    summary: str = ""
+    summarized: int = 0
+    # groq model used for this thread
+    model: str = DEFAULT_MODEL
+
+
+# Only the latest messages are sent to the llm, so the prompt (and the time to first token) stops growing with the chat
+HISTORY_WINDOW = 12  # messages, about 6 turns
+# Older messages are folded into a summary instead of being dropped,
+# in batches so the summary is only rewritten once every few turns and not on every message
+SUMMARIZE_HISTORY = True
+SUMMARY_BATCH = 8
+
+
+async def summarize(summary, messages):
+    conversation = "\n".join(
+        f"{message.type}: {message.content}" for message in messages
+    )
+    prompt = (
+        f"Current summary: {summary or 'none'}\n\n"
+        f"Extend the summary with these messages, keep it short:\n{conversation}"
+    )
+    # tagged nostream so the summary is not streamed to the user as if it was the reply
+    response = await get_llm().ainvoke(prompt, config={"tags": [TAG_NOSTREAM]})
+    return response.content
+
+
+# Greetings and thanks get a canned reply, there is no need to wait for the llm for these
+# a bare "ok" is left to the llm, it is often a go-ahead to something the assistant just offered
+GREETING = "Hi! How can I help you today?"
+THANKS = "You're welcome! Anything else I can help with?"
+TRIVIAL_REPLIES = {
+    "": "Please type a message.",
+    "hi": GREETING,
+    "hello": GREETING,
+    "hey": GREETING,
+    "thanks": THANKS,
+    "thank you": THANKS,
+    "thx": THANKS,
+    "bye": "Goodbye! Have a nice day.",
+}
+# the whole message must be one of the phrases (or nothing), followed only by spaces and ! or .
+TRIVIAL_RE = re.compile(
+    r"^(?:(" + "|".join(phrase for phrase in TRIVIAL_REPLIES if phrase) + r")[\s!.]*)?$"
+)
+
+
+def trivial_reply(text):
+    match = TRIVIAL_RE.match(text.strip().lower())
+    if match:
+        return TRIVIAL_REPLIES[match.group(1) or ""]
+    return None
+
+
+# Response cache
+# The same prompt (same trimmed history, model and length cap) asked again within RESPONSE_TTL seconds, by a retry
+# or by another user, gets the stored reply instead of another groq call
+RESPONSE_CACHE_SIZE = 1024
+RESPONSE_TTL = 600  # seconds
+
+
+class ResponseCache:
+    """Small LRU of reply texts whose entries expire after ttl seconds"""
+
+    def __init__(self, maxsize=RESPONSE_CACHE_SIZE, ttl=RESPONSE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        # key -> (expiry time, reply), oldest used first
+        self.items = OrderedDict()
+
+    def get(self, key):
+        item = self.items.get(key)
+        if item is None:
+            return None
+        expires, reply = item
+        if expires < time.monotonic():
+            del self.items[key]
+            return None
+        self.items.move_to_end(key)
+        return reply
+
+    def put(self, key, reply):
+        self.items[key] = (time.monotonic() + self.ttl, reply)
+        self.items.move_to_end(key)
+        while len(self.items) > self.maxsize:
+            self.items.popitem(last=False)
+
+
+# only used from the background event loop, so no lock is needed
+@st.cache_resource(show_spinner=False)
+def get_response_cache():
+    return ResponseCache()
+
+
+def response_key(messages, model, max_tokens):
+    payload = json.dumps(
+        [model, max_tokens, [(message.type, message.content) for message in messages]]
+    )
+    return hashlib.blake2b(payload.encode(), digest_size=16).hexdigest()
 
 
 # Define the chat node function
-def chat_node(state: ChatState):
+# async so the graph waits on groq without holding a thread
+async def chat_node(state: ChatState, config: RunnableConfig):
     # user query from state
-    message = state["messages"]
+    message = state.messages
+
+    # no llm call for "hi", "thanks" and the like, the returned message is still streamed to the ui
+    if reply := trivial_reply(message[-1].content):
+        return {"messages": [AIMessage(content=reply)]}
 
-    # send query to llm
-    response = llm.invoke(message)
+    model = state.model
+    bin_index = length_bin(message[-1].content)
+
+    if SUMMARIZE_HISTORY:
+        # everything not in the summary yet is sent as it is
+        message = message[state.summarized :]
+        if state.summary:
+            message = [
+                SystemMessage(
+                    content=f"Summary of the earlier conversation: {state.summary}"
+                )
+            ] + message
+    else:
+        message = message[-HISTORY_WINDOW:]
+
+    # drafts turn the cache off, they are meant to be different answers to the same prompt
+    use_cache = config["configurable"].get("cache_response", True)
+    cache = get_response_cache()
+    key = response_key(message, model, BIN_MAX_TOKENS[bin_index])
+    if use_cache and (reply := cache.get(key)) is not None:
+        return {"messages": [AIMessage(content=reply)]}
+
+    # send query to llm, the node config carries the callbacks that stream its tokens
+    # called directly inside the node so cancelling the run also cancels the groq request
+    llm = get_llm(model, max_tokens=BIN_MAX_TOKENS[bin_index])
+    response = await llm.ainvoke(message, config)
+    # a reply cut off by max_tokens is not worth handing to anyone else
+    if use_cache and response.response_metadata.get("finish_reason") != "length":
+        cache.put(key, response.content)
 
     # store response
     return {"messages": [response]}
 
 
-# Define the checkpointer
-checkpoints = InMemorySaver()
+# The summary is written after the reply has streamed, so the turn that folds a batch in does not wait for it
+def needs_summary(state: ChatState, config: RunnableConfig):
+    # draft forks leave the summary to the real chat thread, theirs would be thrown away
+    if not config["configurable"].get("summarize", True):
+        return END
+    # summarize once a whole batch of messages has fallen out of the window
+    window_start = len(state.messages) - HISTORY_WINDOW
+    if SUMMARIZE_HISTORY and window_start - state.summarized >= SUMMARY_BATCH:
+        return "summarize_node"
+    return END
+
+
+async def summarize_node(state: ChatState):
+    window_start = len(state.messages) - HISTORY_WINDOW
+    summary = await summarize(
+        state.summary, state.messages[state.summarized : window_start]
+    )
+    return {"summary": summary, "summarized": window_start}
+
+
+# Checkpointer that only keeps the latest checkpoints of every thread
+# InMemorySaver keeps every step forever and each checkpoint stores the whole message list again,
+# but resuming a chat only ever needs the latest one
+KEEP_CHECKPOINTS = 16  # per thread, a turn makes 2 to 4 of them
+
 
-# Create graph for ChatState
-graph = StateGraph(ChatState)
+class RollingSaver(InMemorySaver):
+    """InMemorySaver that evicts the oldest checkpoints of a thread (and their writes and blobs)"""
 
-# Add nodes and Edges
-graph.add_node("chat_node", chat_node)
+    def __init__(self, keep=KEEP_CHECKPOINTS):
+        super().__init__()
+        self.keep = keep
+        # channel versions of every stored checkpoint, to know which blobs are still in use
+        self.versions = defaultdict(dict)
 
-graph.add_edge(START, "chat_node")
-graph.add_edge("chat_node", END)
+    def put(self, config, checkpoint, metadata, new_versions):
+        next_config = super().put(config, checkpoint, metadata, new_versions)
 
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"]["checkpoint_ns"]
+        versions = self.versions[(thread_id, checkpoint_ns)]
+        versions[checkpoint["id"]] = checkpoint["channel_versions"]
+
+        # dicts keep insertion order so the first ids are the oldest checkpoints
+        checkpoints = self.storage[thread_id][checkpoint_ns]
+        if len(checkpoints) > self.keep:
+            evicted = list(checkpoints)[: len(checkpoints) - self.keep]
+            evicted_versions = [
+                versions.pop(checkpoint_id) for checkpoint_id in evicted
+            ]
+            for checkpoint_id in evicted:
+                del checkpoints[checkpoint_id]
+                self.writes.pop((thread_id, checkpoint_ns, checkpoint_id), None)
+
+            # a blob can be shared with a newer checkpoint when its channel did not change, keep those
+            in_use = {item for kept in versions.values() for item in kept.items()}
+            for channel_versions in evicted_versions:
+                for item in channel_versions.items():
+                    if item not in in_use:
+                        self.blobs.pop((thread_id, checkpoint_ns, *item), None)
+
+        return next_config
+
+    def delete_thread(self, thread_id):
+        super().delete_thread(thread_id)
+        for key in [key for key in self.versions if key[0] == thread_id]:
+            del self.versions[key]
+
+
+# Build the workflow
+# Compiling the graph and creating the checkpointer happens once per process, every streamlit rerun reuses the same
+# workflow (and the InMemorySaver inside it keeps the conversation across reruns)
+@st.cache_resource
+def get_workflow():
+    # Define the checkpointer
+    checkpoints = RollingSaver()
+
+    # Create graph for ChatState
+    graph = StateGraph(ChatState)
+
+    # Add nodes and Edges
+    graph.add_node("chat_node", chat_node)
+    graph.add_node("summarize_node", summarize_node)
+
+    graph.add_edge(START, "chat_node")
+    graph.add_conditional_edges("chat_node", needs_summary)
+    graph.add_edge("summarize_node", END)
+
+    if WARM_UP_LLM:
+        warm_up()
+
+    return graph.compile(checkpointer=checkpoints)
+
+
+# Several drafts of the same reply at once
+# Draft 0 is the real chat thread, the others run on their own fork threads seeded with the same history,
+# and since groq requests are independent all drafts stream at the same time instead of one after the other
+async def astream_drafts(graph_input, config, n_drafts):
+    workflow = get_workflow()
+    thread_id = config["configurable"]["thread_id"]
+    history = (await workflow.aget_state(config)).values
+
+    # cache_response off, a cached reply would make every draft the same
+    configs = [
+        {**config, "configurable": {**config["configurable"], "cache_response": False}}
+    ]
+    for i in range(1, n_drafts):
+        draft_config = {
+            "configurable": {
+                "thread_id": f"{thread_id}-draft-{i}",
+                "cache_response": False,
+                # only draft 0 is kept, so only the real thread summarizes
+                "summarize": False,
+            }
+        }
+        # start every fork again from the current chat, not from its own older drafts
+        workflow.checkpointer.delete_thread(draft_config["configurable"]["thread_id"])
+        if history:
+            await workflow.aupdate_state(draft_config, history, as_node="chat_node")
+        configs.append(draft_config)
+
+    chunks = asyncio.Queue()
+    done = object()
+
+    async def run_draft(index, draft_config):
+        async for message_chunk, _ in workflow.astream(
+            graph_input, config=draft_config, stream_mode="messages"
+        ):
+            if message_chunk.content:
+                await chunks.put((index, message_chunk.content))
+
+    async def run_all():
+        try:
+            await asyncio.gather(*(run_draft(i, c) for i, c in enumerate(configs)))
+        finally:
+            await chunks.put(done)
+
+    task = asyncio.create_task(run_all())
+    try:
+        # (draft index, text) in the order the tokens arrive
+        while (item := await chunks.get()) is not done:
+            yield item
+        # raises the error of a failed draft
+        await task
+    finally:
+        task.cancel()
 
-workflow = graph.compile(checkpointer=checkpoints)
 
 if __name__ == "__main__":
     # Till now we used to do workflow.invoke()
 
     """
-    We will use `.stream` instead of invoke
+    We will use `.astream` instead of invoke (the chat node is async)
     1. Here you need to send Initial State
     2. Our Config to provide thread id
     3. Stream Mode(custom,messages,updates etc)
     """
 
     # This is for testing we will use this same in frontend in place of invoke
-    stream = workflow.stream(
-        # initial state
-        {
-            "messages": HumanMessage(
-                content="Tell the Difference Between Machine Learning and Deep learning in Simple and Short Explaination"
-            )
-        },
-        # Config
-        config={"configurable": {"thread_id": "thread-1"}},
-        # Stream Mode
-        stream_mode="messages",
+    workflow = get_workflow()
+    stream = iter_async(
+        workflow.astream(
+            # initial state
+            {
+                "messages": HumanMessage(
+                    content="Tell the Difference Between Machine Learning and Deep learning in Simple and Short Explaination"
+                )
+            },
+            # Config
+            config={"configurable": {"thread_id": "thread-1"}},
+            # Stream Mode
+            stream_mode="messages",
+        )
     )
 
     # print(type(stream))
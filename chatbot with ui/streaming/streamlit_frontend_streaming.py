@@ -1,18 +1,99 @@
+import re
+import time
+
 import streamlit as st
 from langchain_core.messages import HumanMessage
-from langgraph_backend import workflow
+from langgraph_backend import MODELS, astream_drafts, get_workflow, iter_async
+
+# Compiled once per process and reused on every rerun (st.cache_resource)
+workflow = get_workflow()
 
 # Config for Session Memory
 CONFIG = {"configurable": {"thread_id": "thread-1"}}
 
+# Tokens are painted at most once every PAINT_WINDOW seconds, a redraw (and websocket message) per token
+# at a few hundred tokens a second makes the page slower to follow, not faster
+PAINT_WINDOW = 0.03
+
+
+# Join the chunks that arrive within one window into a single chunk, the first chunk is yielded right away
+def coalesce(chunks, window=PAINT_WINDOW):
+    buffer = []
+    last_paint = 0.0
+    for chunk in chunks:
+        buffer.append(chunk)
+        now = time.monotonic()
+        if now - last_paint >= window:
+            yield "".join(buffer)
+            buffer.clear()
+            last_paint = now
+    if buffer:
+        yield "".join(buffer)
+
+
+# message history is a list of (role, content) tuples, plain strings are all the ui needs
 if "message_history" not in st.session_state:
     st.session_state["message_history"] = []
 
+# How many answers to generate side by side, the first draft is the one kept in the chat
+n_drafts = st.sidebar.slider("Drafts", min_value=1, max_value=4, value=1)
+
+# The first (small and fast) model is the default, pick the bigger one for harder questions
+model = st.sidebar.selectbox("Model", MODELS)
+
+
+# How each role is labelled in the history
+ROLE_LABELS = {"user": "You", "assistant": "Assistant"}
+
+
+# Every message shares one markdown document, so none of them may leak formatting into the next:
+# user text is shown literally and a reply cut off inside a code fence gets the fence closed
+MARKDOWN_PUNCTUATION = re.compile(r"([!-/:-@\[-`{-~])")
+FENCE = re.compile(r"^ {0,3}(`{3,}|~{3,})(.*)$")
+
+
+def escape_markdown(text):
+    # backslash every ascii punctuation character and keep the user's line breaks
+    return "  \n".join(
+        MARKDOWN_PUNCTUATION.sub(r"\\\1", line) for line in text.splitlines()
+    )
+
+
+def close_fences(text):
+    fence = None
+    for line in text.splitlines():
+        match = FENCE.match(line)
+        if not match:
+            continue
+        marker, rest = match.groups()
+        if fence is None:
+            fence = marker
+        # a closing fence uses the same character, is at least as long and has no info string
+        elif marker[0] == fence[0] and len(marker) >= len(fence) and not rest.strip():
+            fence = None
+    return text if fence is None else f"{text}\n{fence}"
+
+
+def format_message(role, content):
+    content = escape_markdown(content) if role == "user" else close_fences(content)
+    # the content starts on its own line so a fence on its first line is still a fence
+    return f"**{ROLE_LABELS[role]}:**\n\n{content}"
+
 
 # To print all message
-for message in st.session_state["message_history"]:
-    with st.chat_message(message["role"]):
-        st.text(message["content"])
+# The history is drawn once per rerun into its own container, while a reply streams only the placeholder below changes
+# All past messages are one markdown element, so a long chat does not create a chat_message component per message
+history_container = st.container()
+if st.session_state["message_history"]:
+    history_container.markdown(
+        "\n\n".join(
+            format_message(role, content)
+            for role, content in st.session_state["message_history"]
+        )
+    )
+
+# the reply of the current turn is streamed into this placeholder
+reply_placeholder = st.empty()
 
 
 user_input = st.chat_input("Type Here")
@@ -20,26 +101,60 @@ user_input = st.chat_input("Type Here")
 
 if user_input:
     # user message
-    st.session_state["message_history"].append({"role": "user", "content": user_input})
-    with st.chat_message("user"):
-        st.text(user_input)
+    st.session_state["message_history"].append(("user", user_input))
+    history_container.markdown(format_message("user", user_input))
+
+    # graph input built once, outside the generator
+    # model_construct skips pydantic validation, user_input is already a plain str from chat_input
+    state = {
+        "messages": HumanMessage.model_construct(content=user_input),
+        "model": model,
+    }
 
     # ai message generation with streaming
-    with st.chat_message("assistant"):
-        # Write stream needs generator
-        ai_message = st.write_stream(
-            # this is our generator which also needs three things
-            # Since it will return the message_chunk and meta_data. But we only need message_chunk
-            # Extracting message chunk using list comprehension for generators
-            message_chunk.content
-            for message_chunk, meta_data in workflow.stream(
-                {"messages": HumanMessage(user_input)},
-                config=CONFIG,
-                stream_mode="messages",
-            )
-        )
+    # the generator keeps only the text of each chunk (not the chunk + meta_data) and the reply is joined once at the end
+    ai_parts = []
+
+    def ai_message_stream():
+        # Since it will return the message_chunk and meta_data. But we only need message_chunk
+        # astream runs on the backend's event loop, iter_async hands its chunks to this thread as they arrive
+        for message_chunk, _ in iter_async(
+            workflow.astream(state, config=CONFIG, stream_mode="messages")
+        ):
+            content = message_chunk.content
+            # skip the empty chunks, each yield costs a redraw and a websocket message
+            if content:
+                ai_parts.append(content)
+                yield content
+
+    if n_drafts == 1:
+        with reply_placeholder.chat_message("assistant"):
+            # Write stream needs generator
+            st.write_stream(coalesce(ai_message_stream()))
+
+        ai_message = "".join(ai_parts)
+    else:
+        # one column per draft, each placeholder is redrawn as its own tokens arrive
+        with reply_placeholder.chat_message("assistant"):
+            placeholders = []
+            for i, column in enumerate(st.columns(n_drafts)):
+                column.caption(f"Draft {i + 1}")
+                placeholders.append(column.empty())
+
+            drafts = [[] for _ in range(n_drafts)]
+            last_paint = [0.0] * n_drafts
+            for index, content in iter_async(astream_drafts(state, CONFIG, n_drafts)):
+                drafts[index].append(content)
+                now = time.monotonic()
+                if now - last_paint[index] >= PAINT_WINDOW:
+                    placeholders[index].markdown("".join(drafts[index]))
+                    last_paint[index] = now
+
+            # the last tokens of every draft may still be waiting for their paint
+            for placeholder, draft in zip(placeholders, drafts):
+                placeholder.markdown("".join(draft))
+
+        ai_message = "".join(drafts[0])
 
     # Appending the entire message to history
-    st.session_state["message_history"].append(
-        {"role": "assistant", "content": ai_message}
-    )
+    st.session_state["message_history"].append(("assistant", ai_message))